@@ -4,33 +4,50 @@
 # LICENSE file in the root directory of this source tree.
 
 import os
+import asyncio
+import itertools
 import streamlit as st
 import datetime
 import uuid
+import re
+import time
+import threading
 import logging
+import faiss
+import numpy as np
 from langchain.schema import HumanMessage
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain.schema import Document
 from langchain_openai import OpenAIEmbeddings
-from langchain.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.callbacks.manager import adispatch_custom_event
 from langgraph.graph import START, END, StateGraph
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_community.tools.tavily_search import TavilySearchResults
-from langchain_community.document_loaders import WebBaseLoader, PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_core.pydantic_v1 import BaseModel, Field
 from typing import List, Dict
 from typing_extensions import TypedDict
 
 
+# Let FAISS searches use every available core
+faiss.omp_set_num_threads(os.cpu_count() or 1)
+
 # Initialize Groq LLM
-llm = ChatGoogleGenerativeAI(model="gemini-1.5-flash", temperature=0.0)
+@st.cache_resource
+def get_llm() -> ChatGoogleGenerativeAI:
+    # Imported here to keep SQLAlchemy off the chapter's import path
+    from langchain_community.cache import SQLiteCache
+
+    # Persistent LLM response cache, reused across Streamlit reruns and restarts
+    llm_cache = SQLiteCache(database_path=".vsa_llm_cache.db")
+    return ChatGoogleGenerativeAI(model="gemini-1.5-flash", temperature=0.0, cache=llm_cache)
 
 
 # Initialize vector store and retriever
 def load_documents(sources: List[str]) -> List:
+    # Document loaders are only needed when the index has to be rebuilt
+    from langchain_community.document_loaders import WebBaseLoader, PyPDFLoader
+
     docs = []
     for source in sources:
         if source.startswith('http'):
@@ -42,6 +59,72 @@ def load_documents(sources: List[str]) -> List:
         docs.extend(loader.load())
     return docs
 
+# HNSW graph parameters for the FAISS index
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+
+# IVF-PQ parameters: 256 inverted lists and 96 one-byte sub-quantizers per vector
+IVF_PQ_FACTORY = "IVF256,PQ96x8"
+IVF_NPROBE = 16
+
+# Minimum number of vectors to train IVF-PQ (39 per centroid); smaller corpora use HNSW
+IVF_PQ_MIN_VECTORS = 256 * 39
+
+def tune_index(index: faiss.Index):
+    """Set the query-time search parameters of a FAISS index."""
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    elif isinstance(index, faiss.IndexIVF):
+        index.nprobe = IVF_NPROBE
+
+def build_faiss_index(vectors: np.ndarray) -> faiss.Index:
+    """
+    Build the FAISS index for the chunk embeddings. Large corpora are
+    compressed with IVF-PQ, smaller ones are stored in an HNSW graph index,
+    so that searches are sub-linear in the number of chunks. OpenAI embeddings
+    are unit-norm, so the index ranks by inner product (cosine similarity).
+
+    Args:
+        vectors (np.ndarray): The chunk embeddings, one float32 row per chunk
+
+    Returns:
+        faiss.Index: The populated index
+    """
+    n, d = vectors.shape
+    if n >= IVF_PQ_MIN_VECTORS:
+        index = faiss.index_factory(d, IVF_PQ_FACTORY, faiss.METRIC_INNER_PRODUCT)
+        index.train(vectors)
+    else:
+        index = faiss.IndexHNSWFlat(d, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    index.add(vectors)
+    tune_index(index)
+    return index
+
+# Number of chunks sent per embedding request
+EMBEDDING_BATCH_SIZE = 1000
+
+# Initialize embeddings once, so every embedding call reuses the same client connections
+@st.cache_resource
+def get_embeddings() -> OpenAIEmbeddings:
+    return OpenAIEmbeddings(chunk_size=EMBEDDING_BATCH_SIZE, max_retries=6)
+
+async def aembed_documents(embeddings: OpenAIEmbeddings, texts: List[str]) -> List[List[float]]:
+    """
+    Embed texts in batches of EMBEDDING_BATCH_SIZE, sending the batches concurrently.
+
+    Args:
+        embeddings (OpenAIEmbeddings): The embedding model
+        texts (list): The texts to embed
+
+    Returns:
+        list: One embedding vector per text, in order
+    """
+    batches = [texts[i:i + EMBEDDING_BATCH_SIZE] for i in range(0, len(texts), EMBEDDING_BATCH_SIZE)]
+    results = await asyncio.gather(*(embeddings.aembed_documents(batch) for batch in batches))
+    return [vector for batch in results for vector in batch]
+
 def create_or_load_vectorstore(sources: List[str], index_name: str = "index_vsa") -> FAISS:
     # Get the current working directory
     current_dir = os.getcwd()
@@ -54,7 +137,11 @@ def create_or_load_vectorstore(sources: List[str], index_name: str = "index_vsa"
     if os.path.exists(f"{index_path}/index.faiss"):
         print(f"Loading existing vector store from {index_path}/index.faiss")
         try:
-            vectorstore = FAISS.load_local(index_path, OpenAIEmbeddings(), allow_dangerous_deserialization=True)
+            vectorstore = FAISS.load_local(index_path, get_embeddings(), allow_dangerous_deserialization=True)
+            tune_index(vectorstore.index)
+            # Indexes built before the switch to inner product still use L2
+            if vectorstore.index.metric_type == faiss.METRIC_INNER_PRODUCT:
+                vectorstore.distance_strategy = DistanceStrategy.MAX_INNER_PRODUCT
             print("Vector store loaded successfully.")
             return vectorstore
         except Exception as e:
@@ -64,12 +151,30 @@ def create_or_load_vectorstore(sources: List[str], index_name: str = "index_vsa"
         print(f"Vector store not found at {index_path}/index.faiss")
     
     print("Creating new vector store...")
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+
     docs = load_documents(sources)
     text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-        chunk_size=100, chunk_overlap=50
+        chunk_size=512, chunk_overlap=64
     )
     doc_splits = text_splitter.split_documents(docs)
-    vectorstore = FAISS.from_documents(doc_splits, OpenAIEmbeddings())
+    embeddings = get_embeddings()
+    # Build the index manually so it can be trained (IVF-PQ) before vectors are added
+    texts = [d.page_content for d in doc_splits]
+    vectors = asyncio.run(aembed_documents(embeddings, texts))
+    index = build_faiss_index(np.asarray(vectors, dtype="float32"))
+    index_to_docstore_id = {i: str(uuid.uuid4()) for i in range(len(doc_splits))}
+    docstore = InMemoryDocstore(
+        {index_to_docstore_id[i]: d for i, d in enumerate(doc_splits)}
+    )
+    vectorstore = FAISS(
+        embeddings,
+        index,
+        docstore,
+        index_to_docstore_id,
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+    )
     
     print(f"Saving vector store to {index_path}...")
     try:
@@ -86,67 +191,126 @@ sources = [
     "./index_vsa/vsa.pdf"
 ]
 
-# Create or load vector store
-vectorstore = create_or_load_vectorstore(sources)
+# Create or load vector store, kept in memory across Streamlit reruns
+@st.cache_resource
+def get_vectorstore() -> FAISS:
+    return create_or_load_vectorstore(sources)
+
+
+class SemanticRetrieverCache:
+    """
+    Semantic cache in front of a vector store search.
+
+    The embedding of each question is compared (cosine similarity) against the
+    embeddings of previously answered questions. A near-duplicate question
+    reuses the cached documents instead of searching the vector store again.
+    Entries expire after `ttl` seconds and at most `max_size` are kept.
+    """
+
+    def __init__(self, vectorstore: FAISS, k: int = 10, threshold: float = 0.95, max_size: int = 256, ttl: float = 3600):
+        self.vectorstore = vectorstore
+        self.k = k
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.index = None
+        self.vectors = []
+        self.entries = []
+        self.lock = threading.Lock()
+
+    def _rebuild(self, keep: List[int]):
+        self.vectors = [self.vectors[i] for i in keep]
+        self.entries = [self.entries[i] for i in keep]
+        self.index = None
+        if self.vectors:
+            self.index = faiss.IndexFlatIP(self.vectors[0].shape[1])
+            self.index.add(np.vstack(self.vectors))
+
+    def _evict(self):
+        now = time.time()
+        keep = [i for i, (timestamp, _) in enumerate(self.entries) if now - timestamp < self.ttl]
+        keep = keep[-self.max_size:]
+        if len(keep) != len(self.entries):
+            self._rebuild(keep)
+
+    def invoke(self, question_embedding: List[float]) -> List[Document]:
+        vector = np.asarray([question_embedding], dtype="float32")
+        faiss.normalize_L2(vector)
+
+        with self.lock:
+            self._evict()
+            if self.index is not None:
+                scores, ids = self.index.search(vector, 1)
+                if scores[0][0] >= self.threshold:
+                    return list(self.entries[ids[0][0]][1])
+
+        documents = self.vectorstore.similarity_search_by_vector(question_embedding, k=self.k)
+
+        with self.lock:
+            if self.index is None:
+                self.index = faiss.IndexFlatIP(vector.shape[1])
+            self.index.add(vector)
+            self.vectors.append(vector)
+            self.entries.append((time.time(), documents))
+            self._evict()
+        return list(documents)
+
 
 # Create retriever
-retriever = vectorstore.as_retriever(search_kwargs={"k": 10})
+@st.cache_resource
+def get_retriever() -> SemanticRetrieverCache:
+    return SemanticRetrieverCache(get_vectorstore(), k=10)
 
 # Initialize web search tool
-web_search_tool = TavilySearchResults()
-
-rag_prompt = PromptTemplate(
-    template="""
-    You are a Vessel Sharing Agreement (VSA) specialist with a deep understanding of maritime logistics and shipping contracts. Your task is to provide detailed and accurate information in response to user questions about VSAs, particularly focusing on the agreement between CHERRY and OLIVE shipping liners.
-
-    Guidelines for answering:
-    1. Use the provided context (Documents) to answer the user's question in detail.
-    2. Create a final answer with references, using "SOURCE[number]" in capital letters (e.g., SOURCE[1], SOURCE[2]).
-    3. Present information in a clear, concise, and easily understandable manner, using bullet points for organization when appropriate.
-    4. If the question is unclear, politely ask the user for clarification.
-    5. For questions about specific VSA terms:
-       - Provide details on: definition, relevant clauses, obligations of parties, penalties or compensations (if applicable), and any related operational procedures.
-       - If this information is not in the provided context, state that you need to refer to the full VSA document for accurate details.
-    6. Respond in the language of the user's question. If unable to determine the language, default to English.
-    7. If you don't know the answer or if the information is not in the provided context, clearly state "I don't have enough information to answer this question accurately. Please refer to the full Vessel Sharing Agreement document or consult with a VSA expert for the most up-to-date and accurate information."
-    8. Limit your response to a maximum of 300 words unless the question specifically requires a longer answer.
-
-    Context format:
-    The 'Documents' field contains relevant excerpts from the Vessel Sharing Agreement and related sources. Each document is separated by triple dashes (---) and may include metadata such as section titles or clause numbers.
-
-    Question: {question}
-    Documents: {documents}
-    Answer:
-    """,
-    input_variables=["question", "documents"],
+@st.cache_resource
+def get_web_search_tool():
+    # Imported on first web search to keep it off the import path
+    from langchain_community.tools.tavily_search import TavilySearchResults
+
+    return TavilySearchResults()
+
+# Fixed instructions go in the system message so the per-call input stays small
+rag_system = """You are a Vessel Sharing Agreement (VSA) specialist for the agreement between the CHERRY and OLIVE shipping liners.
+Rules:
+1. Answer from the provided Documents, citing them as SOURCE[number] (e.g., SOURCE[1]).
+2. Be clear and concise; use bullet points when helpful.
+3. If the question is unclear, ask for clarification.
+4. For VSA terms, cover definition, clauses, obligations, penalties or compensations, and procedures found in the Documents.
+5. Answer in the language of the question (default English).
+6. If the Documents do not contain the answer, say "I don't have enough information to answer this question accurately. Please refer to the full Vessel Sharing Agreement document."
+7. Keep the answer under 300 words unless the question requires more."""
+
+rag_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", rag_system),
+        ("human", "Question: {question}\nDocuments: {documents}"),
+    ]
 )
 
-rag_chain = rag_prompt | llm | StrOutputParser()
+# Answer generation chain
+@st.cache_resource
+def get_rag_chain():
+    return rag_prompt | get_llm() | StrOutputParser()
 
-# Data model for the output
-class GradeDocuments(BaseModel):
-    """Binary score for relevance check on retrieved documents."""
+# Tag marking the answer generation whose tokens are streamed to the chat window
+STREAM_TAG = "vsa_answer"
 
-    binary_score: str = Field(
-        description="Documents are relevant to the question, 'yes' or 'no'"
-    )
+# Tag marking the speculative draft; its tokens are streamed only once the draft is kept
+DRAFT_TAG = "vsa_draft"
+DRAFT_KEPT_EVENT = "vsa_draft_kept"
 
-# LLM with tool call
-structured_llm_grader = llm.with_structured_output(GradeDocuments)
+# Grader LLM: the shared LLM with its reply capped at two tokens, enough for "yes"/"no"
+@st.cache_resource
+def get_grader_llm():
+    return get_llm().bind(generation_config={"max_output_tokens": 2})
 
-# Prompt
-system = """You are a teacher grading a quiz. You will be given: 
-1/ a QUESTION 
-2/ a set of comma separated FACTS provided by the student
-
-You are grading RELEVANCE RECALL:
-A score of 1 means that ANY of the FACTS are relevant to the QUESTION. 
-A score of 0 means that NONE of the FACTS are relevant to the QUESTION. 
-1 is the highest (best) score. 0 is the lowest score you can give. 
+def parse_grade(raw: str) -> str:
+    """Map a raw grader reply to 'yes' or 'no'."""
+    return "yes" if raw.strip().lower().startswith("y") else "no"
 
-Explain your reasoning in a step-by-step manner. Ensure your reasoning and conclusion are correct. 
-
-Avoid simply stating the correct answer at the outset."""
+# Prompt
+system = """You are grading whether FACTS are relevant to a QUESTION.
+Reply with exactly one word: yes if ANY of the FACTS are relevant to the QUESTION, otherwise no."""
 
 grade_prompt = ChatPromptTemplate.from_messages(
     [
@@ -155,7 +319,77 @@ grade_prompt = ChatPromptTemplate.from_messages(
     ]
 )
 
-retrieval_grader = grade_prompt | structured_llm_grader
+# Per-document grader chain
+@st.cache_resource
+def get_retrieval_grader():
+    return grade_prompt | get_grader_llm() | StrOutputParser() | parse_grade
+
+# Upper bound on simultaneous grader calls to the LLM
+GRADER_MAX_CONCURRENCY = 8
+
+# Documents graded per batched grader call, in retrieval order
+GRADER_BATCH_SIZE = 5
+
+# Grading stops once this many relevant documents have been found
+MIN_RELEVANT_DOCUMENTS = 4
+
+def parse_grades(raw: str) -> List[str]:
+    """Extract the 'yes'/'no' verdicts, in order, from a raw batch grader reply."""
+    return re.findall(r"\b(yes|no)\b", raw.lower())
+
+# Prompt
+batch_system = """You are a teacher grading a quiz. You will be given: 
+1/ a QUESTION 
+2/ a numbered list of FACTS blocks, each starting with DOC[i] and separated by triple dashes (---)
+
+You are grading RELEVANCE RECALL for each FACTS block independently:
+"yes" means that the block DOC[i] is relevant to the QUESTION. 
+"no" means that the block DOC[i] is not relevant to the QUESTION. 
+
+Reply with only a JSON array of "yes"/"no" verdicts with exactly one entry per block, where entry i is the verdict for DOC[i]."""
+
+batch_grade_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", batch_system),
+        ("human", "FACTS: \n {documents} \n\n QUESTION: {question}"),
+    ]
+)
+
+# Batched grader chain
+@st.cache_resource
+def get_batch_retrieval_grader():
+    return batch_grade_prompt | get_llm() | StrOutputParser() | parse_grades
+
+
+async def grade_batch(question: str, documents: List[Document]) -> List[str]:
+    """
+    Grade all documents with a single LLM call. Falls back to concurrent
+    per-document grading if the batched verdicts cannot be parsed.
+
+    Args:
+        question (str): The user question
+        documents (list): The documents to grade
+
+    Returns:
+        list: One 'yes' or 'no' grade per document, in order
+    """
+    if not documents:
+        return []
+
+    payload = "".join(f"\n---\nDOC[{i}]: {d.page_content}" for i, d in enumerate(documents))
+    try:
+        grades = await get_batch_retrieval_grader().ainvoke({"question": question, "documents": payload})
+        if len(grades) == len(documents):
+            return grades
+        print(f"Batch grader returned {len(grades)} scores for {len(documents)} documents.")
+    except Exception as e:
+        print(f"Error parsing batch grades: {e}")
+    print("Falling back to per-document grading.")
+
+    inputs = [{"question": question, "documents": d.page_content} for d in documents]
+    return await get_retrieval_grader().abatch(
+        inputs, config={"max_concurrency": GRADER_MAX_CONCURRENCY}
+    )
 
 
 class GraphState(TypedDict):
@@ -167,9 +401,11 @@ class GraphState(TypedDict):
         generation: LLM generation
         search: whether to add search
         documents: list of documents
+        question_embedding: embedding of the question
     """
 
     question: str
+    question_embedding: List[float]
     generation: str
     search: str
     documents: List[str]
@@ -177,29 +413,134 @@ class GraphState(TypedDict):
     answer: str
 
 
-def retrieve(state):
+# Documents sharing more than this fraction of word shingles are near-duplicates
+DUPLICATE_JACCARD_THRESHOLD = 0.8
+
+def shingles(text: str, size: int = 5) -> set:
+    """Return the set of word n-grams (shingles) of a text."""
+    words = text.split()
+    return {tuple(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}
+
+def deduplicate_documents(documents: List[Document]) -> List[Document]:
+    """
+    Drop exact and near-duplicate documents, keeping the first (best ranked) one.
+
+    Args:
+        documents (list): The documents in retrieval order
+
+    Returns:
+        list: The documents without duplicates, in the same order
     """
-    Retrieve documents
+    seen = set()
+    kept = []
+    kept_shingles = []
+    for d in documents:
+        if d.page_content in seen:
+            continue
+        seen.add(d.page_content)
+        doc_shingles = shingles(d.page_content)
+        if any(
+            len(doc_shingles & other) / len(doc_shingles | other) > DUPLICATE_JACCARD_THRESHOLD
+            for other in kept_shingles
+        ):
+            continue
+        kept.append(d)
+        kept_shingles.append(doc_shingles)
+    return kept
+
+
+# Questions mentioning these words are likely to need information from the web
+WEB_SEARCH_KEYWORDS = ("latest", "recent", "news", "today", "current", "update")
+WEB_SEARCH_PATTERN = re.compile(r"\b(" + "|".join(WEB_SEARCH_KEYWORDS) + r")\b", re.IGNORECASE)
+
+def needs_web_search(question: str) -> bool:
+    """Cheap keyword heuristic for questions that likely need external information."""
+    return WEB_SEARCH_PATTERN.search(question) is not None
+
+
+# Seconds to wait for web search results before answering without them
+WEB_SEARCH_TIMEOUT = 3.0
+
+async def search_web(question: str) -> List[Document]:
+    """
+    Search the web for the question, giving up after WEB_SEARCH_TIMEOUT seconds.
+
+    Args:
+        question (str): The user question
+
+    Returns:
+        list: The web results as documents, or an empty list on timeout or error
+    """
+    try:
+        web_results = await asyncio.wait_for(
+            get_web_search_tool().ainvoke({"query": question}),
+            timeout=WEB_SEARCH_TIMEOUT,
+        )
+    except asyncio.TimeoutError:
+        print(f"Web search timed out after {WEB_SEARCH_TIMEOUT} seconds.")
+        return []
+    except Exception as e:
+        print(f"Error in web search: {e}")
+        return []
+    # The search tool reports errors as a string instead of raising
+    if not isinstance(web_results, list):
+        print(f"Error in web search: {web_results}")
+        return []
+    return [
+        Document(page_content=d["content"], metadata={"url": d["url"]})
+        for d in web_results
+    ]
+
+
+async def retrieve(state):
+    """
+    Retrieve documents. The question is embedded once; the embedding is used
+    for the semantic cache lookup and the vector store search, and is kept in
+    the state for later steps. For questions flagged by needs_web_search, the
+    web search runs concurrently with retrieval and its results are interleaved
+    with the retrieved documents.
+    Duplicate documents are dropped before grading.
 
     Args:
         state (dict): The current graph state
 
     Returns:
-        state (dict): New key added to state, documents, that contains retrieved documents
+        state (dict): New keys added to state, documents and question_embedding
     """
     question = state["question"]
-    documents = retriever.invoke(question)
     if state["steps"]:
         steps = state["steps"]
     else:
         steps = []
     steps.append("retrieve_documents")
-    return {"documents": documents, "question": question, "steps": steps}
+    web_search_task = None
+    if needs_web_search(question):
+        web_search_task = asyncio.create_task(search_web(question))
+    question_embedding = await asyncio.to_thread(get_embeddings().embed_query, question)
+    # Resolve the retriever off the event loop: building a missing index runs its own asyncio.run
+    documents = await asyncio.to_thread(lambda: get_retriever().invoke(question_embedding))
+    if web_search_task is not None:
+        # Interleave both pools so each grading batch, which may stop early, holds both
+        web_documents = await web_search_task
+        documents = [
+            d
+            for pair in itertools.zip_longest(documents, web_documents)
+            for d in pair
+            if d is not None
+        ]
+        steps.append("web_search")
+    documents = deduplicate_documents(documents)
+    return {
+        "documents": documents,
+        "question": question,
+        "question_embedding": question_embedding,
+        "steps": steps,
+    }
 
 
-def generate(state):
+async def generate(state):
     """
-    Generate answer
+    Generate answer, streaming tokens to any astream_events consumer
 
     Args:
         state (dict): The current graph state
@@ -210,7 +551,10 @@ def generate(state):
 
     question = state["question"]
     documents = state["documents"]
-    generation = rag_chain.invoke({"documents": documents, "question": question})
+    # ainvoke keeps the LLM cache in use; under astream_events it still emits tokens
+    generation = await get_rag_chain().with_config(tags=[STREAM_TAG]).ainvoke(
+        {"documents": documents, "question": question}
+    )
     steps = state["steps"]
     steps.append("generate_answer")
     return {
@@ -221,44 +565,97 @@ def generate(state):
     }
 
 
-def grade_documents(state):
+async def grade_documents(state):
     """
     Determines whether the retrieved documents are relevant to the question.
+    Documents are graded in batches of GRADER_BATCH_SIZE (see grade_batch). All
+    batches are sent concurrently and their grades are consumed in retrieval
+    order; once MIN_RELEVANT_DOCUMENTS relevant documents are found, batches
+    still in flight are cancelled and their documents are dropped. Grades of
+    batches that already finished are kept.
+
+    While grading runs, a draft answer is generated from the first batch of
+    documents. The draft is kept if exactly that batch turns out to be relevant
+    and no web search is needed, otherwise it is cancelled and the answer is
+    generated from the filtered documents.
 
     Args:
         state (dict): The current graph state
 
     Returns:
-        state (dict): Updates documents key with only filtered relevant documents
+        state (dict): Updates documents key with only filtered relevant documents,
+        and generation key with the draft answer if it was kept
     """
 
     question = state["question"]
     documents = state["documents"]
     steps = state["steps"]
     steps.append("grade_document_retrieval")
+    draft_docs = documents[:GRADER_BATCH_SIZE]
+    draft = asyncio.create_task(
+        get_rag_chain().with_config(tags=[DRAFT_TAG]).ainvoke({"documents": draft_docs, "question": question})
+    )
     filtered_docs = []
     search = "No"
-    for d in documents:
-        score = retrieval_grader.invoke(
-            {"question": question, "documents": d.page_content}
-        )
-        grade = score.binary_score
-        if grade == "yes":
-            filtered_docs.append(d)
-        else:
-            search = "Yes"
-            continue
+    batches = [documents[i:i + GRADER_BATCH_SIZE] for i in range(0, len(documents), GRADER_BATCH_SIZE)]
+    grading = [asyncio.create_task(grade_batch(question, batch)) for batch in batches]
+    batch_grades = [None] * len(batches)
+    keep_draft = False
+    try:
+        relevant = 0
+        for i, task in enumerate(grading):
+            batch_grades[i] = await task
+            relevant += batch_grades[i].count("yes")
+            if relevant >= MIN_RELEVANT_DOCUMENTS:
+                break
+        # Finished batches are already paid for, so their grades are used too
+        for i, task in enumerate(grading):
+            if batch_grades[i] is None and task.done() and not task.cancelled() and task.exception() is None:
+                batch_grades[i] = task.result()
+        for batch, grades in zip(batches, batch_grades):
+            if grades is None:
+                continue
+            for d, grade in zip(batch, grades):
+                if grade == "yes":
+                    filtered_docs.append(d)
+                else:
+                    search = "Yes"
+                    continue
+        if len(filtered_docs) >= MIN_RELEVANT_DOCUMENTS:
+            search = "No"
+        keep_draft = search == "No" and filtered_docs == draft_docs
+    finally:
+        for task in grading:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()  # Mark errors of skipped batches as retrieved
+        # Also cancels the draft when grading fails
+        if not keep_draft:
+            draft.cancel()
+
+    generation = ""
+    if keep_draft:
+        # Lets astream_answer forward the draft tokens to the chat window
+        await adispatch_custom_event(DRAFT_KEPT_EVENT, {})
+        try:
+            generation = await draft
+            steps.append("generate_answer")
+        except Exception as e:
+            print(f"Error generating draft answer: {e}")
     return {
         "documents": filtered_docs,
         "question": question,
         "search": search,
+        "generation": generation,
         "steps": steps,
     }
 
 
-def web_search(state):
+async def web_search(state):
     """
-    Web search based on the re-phrased question.
+    Web search based on the re-phrased question. If the search times out,
+    the documents are passed on as they are.
 
     Args:
         state (dict): The current graph state
@@ -271,13 +668,7 @@ def web_search(state):
     documents = state.get("documents", [])
     steps = state["steps"]
     steps.append("web_search")
-    web_results = web_search_tool.invoke({"query": question})
-    documents.extend(
-        [
-            Document(page_content=d["content"], metadata={"url": d["url"]})
-            for d in web_results
-        ]
-    )
+    documents.extend(await search_web(question))
     return {"documents": documents, "question": question, "steps": steps}
 
 
@@ -289,56 +680,154 @@ def decide_to_generate(state):
         state (dict): The current graph state
 
     Returns:
-        str: Binary decision for next node to call
+        str: Decision for next node to call
     """
     search = state["search"]
-    if search == "Yes":
+    # Web results fetched alongside retrieval are not searched for again
+    if search == "Yes" and "web_search" not in state["steps"]:
         return "search"
+    # Generation has run (even if it returned an empty answer)
+    elif "generate_answer" in state["steps"]:
+        return "end"
     else:
         return "generate"
 
 
+async def retrieve_grade_generate(state):
+    """
+    Retrieve and grade documents, and generate the answer when no web search
+    is needed, in a single node. This runs the common path without a graph
+    transition (and state copy) between each step.
+
+    Args:
+        state (dict): The current graph state
+
+    Returns:
+        state (dict): The state after retrieve, grade_documents and, when
+        decide_to_generate chooses it, generate
+    """
+    state = {**state, **await retrieve(state)}
+    state = {**state, **await grade_documents(state)}
+    if decide_to_generate(state) == "generate":
+        state = {**state, **await generate(state)}
+    return state
+
+
 # Graph
 workflow = StateGraph(GraphState)
 
 # Define the nodes
-workflow.add_node("retrieve", retrieve)  # retrieve
-workflow.add_node("grade_documents", grade_documents)  # grade documents
+workflow.add_node("retrieve_grade_generate", retrieve_grade_generate)  # retrieve, grade documents and generate
 workflow.add_node("generate", generate)  # generatae
 workflow.add_node("web_search", web_search)  # web search
 
 # Build graph
-workflow.set_entry_point("retrieve")
-workflow.add_edge("retrieve", "grade_documents")
+workflow.set_entry_point("retrieve_grade_generate")
 workflow.add_conditional_edges(
-    "grade_documents",
+    "retrieve_grade_generate",
     decide_to_generate,
     {
         "search": "web_search",
         "generate": "generate",
+        "end": END,
     },
 )
 workflow.add_edge("web_search", "generate")
 workflow.add_edge("generate", END)
 
-app = workflow.compile()
+# Compile the graph once and keep it across Streamlit reruns
+@st.cache_resource
+def get_app():
+    return workflow.compile()
+
+def load_llm_chains():
+    """
+    Build the cached LLM chains before any event loop is running. Created inside
+    a running loop, the Gemini client binds a gRPC channel to that loop, which
+    is closed after the turn, so later turns would fail.
+    """
+    get_rag_chain()
+    get_retrieval_grader()
+    get_batch_retrieval_grader()
 
 # Function for processing main workflows
 def vsa_validator(prompt: str):
-    response = app.invoke({
+    load_llm_chains()
+    response = asyncio.run(get_app().ainvoke({
         "question": prompt,
         "answer": "",
         "raw_data": "",
         "next": ""
-    })
+    }))
     return response["generation"]
 
+def iterate_async(async_iterator):
+    """
+    Drive an async iterator from synchronous code such as st.write_stream.
+
+    Args:
+        async_iterator: The async generator to consume
+
+    Yields:
+        The items produced by the async generator
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(async_iterator.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(async_iterator.aclose())
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+async def astream_answer(inputs: Dict, config: Dict, response: Dict):
+    """
+    Run the workflow and yield answer tokens as they are generated.
+
+    Args:
+        inputs (dict): The initial graph state
+        config (dict): The graph run configuration
+        response (dict): Updated in place with the final graph state
+
+    Yields:
+        str: Answer tokens from the generate node, or from the speculative
+        draft once grading has kept it (tokens produced before are replayed)
+    """
+    root_run_id = None
+    draft_kept = False
+    draft_tokens = []
+    async for event in get_app().astream_events(inputs, config, version="v2"):
+        if root_run_id is None:
+            root_run_id = event["run_id"]
+        tags = event.get("tags", [])
+        if event["event"] == "on_chat_model_stream" and STREAM_TAG in tags:
+            yield event["data"]["chunk"].content
+        elif event["event"] == "on_chat_model_stream" and DRAFT_TAG in tags:
+            if draft_kept:
+                yield event["data"]["chunk"].content
+            else:
+                draft_tokens.append(event["data"]["chunk"].content)
+        elif event["event"] == "on_custom_event" and event["name"] == DRAFT_KEPT_EVENT:
+            draft_kept = True
+            for token in draft_tokens:
+                yield token
+            draft_tokens = []
+        elif event["event"] == "on_chain_end" and event["run_id"] == root_run_id:
+            response.update(event["data"]["output"])
+
 # Function for processing streamlit questions
 def run_streamlit():
         # Initialize session state for VSA messages
     if "schedule_messages" not in st.session_state:
         st.session_state.schedule_messages = []
 
+    # Keep one graph thread id per user session
+    if "vsa_thread_id" not in st.session_state:
+        st.session_state.vsa_thread_id = str(uuid.uuid4())
+
     # Display chat messages
     for message in st.session_state.schedule_messages:
         with st.chat_message(message["role"]):
@@ -362,27 +851,29 @@ def run_streamlit():
         # Get AI response
         with st.spinner("Thinking..."):
             try:
-                config = {"configurable": {"thread_id": str(uuid.uuid4())}}
-                response = app.invoke(
-                    {
-                        "question": prompt,
-                        "generation": "",
-                        "search": "",
-                        "documents": [],
-                        "steps": []
-                    },
-                    config
-                )
-                ai_response = response.get("generation", "No response generated")
+                config = {"configurable": {"thread_id": st.session_state.vsa_thread_id}}
+                inputs = {
+                    "question": prompt,
+                    "generation": "",
+                    "search": "",
+                    "documents": [],
+                    "steps": []
+                }
+                response = {}
+                load_llm_chains()
+
+                # Stream the answer as it is generated
+                with st.chat_message("assistant"):
+                    streamed = st.write_stream(iterate_async(astream_answer(inputs, config, response)))
+                    ai_response = response.get("generation") or "No response generated"
+                    # An answer served from the LLM cache is not streamed, so display it at once
+                    if not streamed:
+                        st.markdown(ai_response)
                 ai_steps = response.get("steps", [])
                 ai_timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             
-                # Add and display AI response
+                # Add AI response
                 st.session_state.schedule_messages.append({"role": "assistant", "content": ai_response, "timestamp": ai_timestamp, "steps": ai_steps})
-                with st.chat_message("assistant"):
-                    st.markdown(f"{ai_response}\n\n<div style='font-size:0.8em; color:#888;'>{ai_timestamp}</div>", unsafe_allow_html=True)
-                    with st.expander("View steps"):
-                        st.write(ai_steps)
             except Exception as e:
                 st.error(f"An error occurred: {e}")
         